@@ -1,107 +1,397 @@
+import json
 import platform
 import os
+import re
 import shutil
+import sys
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-file_names = {
+# Optional: with the shaderc bindings (pip install pyshaderc) available,
+# shaders compile in-process through libshaderc with no process spawns.
+try:
+    import shaderc
+except ImportError:
+    shaderc = None
+
+BUILD_CACHE = '.build_cache.json'
+SHADER_CACHE = 'shaders/.shader_cache.json'
+INCLUDE_DIR = 'shaders/include'
+INCLUDE_PATTERN = re.compile(r'^\s*#include\s+"([^"]+)"', re.MULTILINE)
+
+# Headers shared between shaders are read once per run, not once per shader
+# that includes them.
+_source_cache = {}
+
+
+def read_source(path):
+    if path not in _source_cache:
+        with open(path) as f:
+            _source_cache[path] = f.read()
+    return _source_cache[path]
+
+
+def resolve_include(name, from_path):
+    """Resolve an #include the way the compiler does: next to the including
+    file first, then in the shared include folder."""
+    local = os.path.join(os.path.dirname(from_path), name)
+    if os.path.exists(local):
+        return local
+    return os.path.join(INCLUDE_DIR, name)
+
+
+def include_mtimes(src):
+    """Collect mtimes of every file transitively #include'd by src."""
+    mtimes = {}
+    pending = [src]
+    seen = set()
+    while pending:
+        path = pending.pop()
+        if path in seen or not os.path.exists(path):
+            continue
+        seen.add(path)
+        if path != src:
+            mtimes[path] = os.stat(path).st_mtime
+        for included in INCLUDE_PATTERN.findall(read_source(path)):
+            pending.append(resolve_include(included, path))
+    return mtimes
+
+
+def input_snapshot():
+    """Map every build input file to its mtime, one scandir pass per folder."""
+    snap = {}
+    pending = ['./shaders', './models', './resource', './textures']
+    while pending:
+        for entry in os.scandir(pending.pop()):
+            # The shader cache is rewritten by the build itself; tracking it
+            # would make every snapshot look dirty.
+            if entry.name == os.path.basename(SHADER_CACHE):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            else:
+                snap[entry.path] = entry.stat().st_mtime_ns
+    if os.path.exists('./.env'):
+        snap['./.env'] = os.stat('./.env').st_mtime_ns
+    snap['BUILD_PROFILE'] = profile
+    return snap
+
+
+def snapshot(root):
+    """Materialize a directory in one scandir pass; entries carry cached
+    stat data, so membership tests cost no further syscalls."""
+    if not os.path.isdir(root):
+        return {}
+    return {e.name: e for e in os.scandir(root)}
+
+
+def outputs_present():
+    for t in targets:
+        entries = snapshot(t)
+        if any(name not in entries
+               for name in ['.env', 'models', 'resource', 'textures']):
+            return False
+        compiled = snapshot(t + '/shaders')
+        if any(y not in compiled for y in file_names.values()):
+            return False
+    return True
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst, falling back to a symlink and then a byte copy.
+
+    The game only ever reads these assets from the target folders, so a link
+    is indistinguishable from a copy at runtime but costs one inode instead
+    of a full duplicate of the file."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+
+def sync_tree(src, dst):
+    """Mirror src into dst, copying only files whose size or mtime changed."""
+    os.makedirs(dst, exist_ok=True)
+    dst_entries = {e.name: e for e in os.scandir(dst)}
+    src_names = set()
+    for entry in os.scandir(src):
+        src_names.add(entry.name)
+        target = os.path.join(dst, entry.name)
+        existing = dst_entries.get(entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            if existing is not None and not existing.is_dir(follow_symlinks=False):
+                os.remove(target)
+            sync_tree(entry.path, target)
+            continue
+        if existing is not None and existing.is_dir(follow_symlinks=False):
+            shutil.rmtree(target)
+            existing = None
+        if existing is None or (entry.stat().st_mtime_ns, entry.stat().st_size) \
+                != (existing.stat().st_mtime_ns, existing.stat().st_size):
+            link_or_copy(entry.path, target)
+    # Second pass: drop anything in dst that no longer exists in src.
+    for name, existing in dst_entries.items():
+        if name in src_names:
+            continue
+        if existing.is_dir(follow_symlinks=False):
+            shutil.rmtree(existing.path)
+        else:
+            os.remove(existing.path)
+
+
+def fanout(src, dsts):
+    """Copy src to every destination, opening the source only once.
+
+    Where os.copy_file_range exists the bytes move kernel-side without ever
+    entering userspace; elsewhere fall back to one read and many writes."""
+    if hasattr(os, 'copy_file_range'):
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            size = os.fstat(src_fd).st_size
+            for dst in dsts:
+                with open(dst, 'wb') as f:
+                    copied = 0
+                    while copied < size:
+                        copied += os.copy_file_range(
+                            src_fd, f.fileno(), size - copied, copied, copied)
+        finally:
+            os.close(src_fd)
+    else:
+        data = Path(src).read_bytes()
+        for dst in dsts:
+            Path(dst).write_bytes(data)
+
+
+def compile_in_process(compiler, options, src, dst):
+    """Compile one GLSL source to SPIR-V through libshaderc."""
+    kind = {
+        '.vert': shaderc.ShaderKind.vertex_shader,
+        '.frag': shaderc.ShaderKind.fragment_shader,
+        '.comp': shaderc.ShaderKind.compute_shader,
+    }[os.path.splitext(src)[1]]
+    result = compiler.compile_into_spv(Path(src).read_text(), kind, src, 'main',
+                                       options)
+    Path(dst).write_bytes(result.get_bytes())
+
+
+# Output names the Rust loader expects that don't follow the stage-suffix rule.
+OUTPUT_OVERRIDES = {
     'basicShader.vert': 'vert.spv',
+    'basicShader.frag': 'frag.spv',
     'basicShader_animated.vert': 'basicShader_animated.spv',
     'basicShader_noTexture.frag': 'basicShader_noTexture.spv',
-    'terrain.vert': 'terrain_vert.spv',
-    'instance.vert': 'instance_vert.spv',
-    'ui.vert': 'ui_vert.spv',
-    'ui.frag': 'ui_frag.spv'
 }
 
-plt = platform.system()
-if plt == 'Windows':
-    file_names['instance.frag'] = 'instance_frag.spv'
-    file_names['water.frag'] = 'water_frag.spv'
-    file_names['terrain.frag'] = 'terrain_frag.spv'
-    file_names['basicShader.frag'] = 'frag.spv'
-elif plt == 'Darwin':
-    file_names['macos/instance.frag'] = 'instance_frag.spv'
-    file_names['macos/water.frag'] = 'water_frag.spv'
-    file_names['macos/terrain.frag'] = 'terrain_frag.spv'
-    file_names['macos/basicShader.frag'] = 'frag.spv'
-
-# Compile shaders
-os.chdir('./shaders')
-for x, y in file_names.items():
-    os.system('glslangValidator -V {} -o {}'.format(x, y))
-
-# Create the folder in case the folder doesn't exist
-os.chdir('../')
-if not os.path.exists('./target'):
-    os.makedirs('./target')
-if not os.path.exists('./target/debug'):
-    os.makedirs('./target/debug')
-if not os.path.exists('./target/debug/shaders'):
-    os.makedirs('./target/debug/shaders')
-if not os.path.exists('./target/debug/models'):
-    os.makedirs('./target/debug/models')
-if not os.path.exists('./target/debug/resource'):
-    os.makedirs('./target/debug/resource')
-if not os.path.exists('./target/debug/textures'):
-    os.makedirs('./target/debug/textures')
-
-if not os.path.exists('./target/release'):
-    os.makedirs('./target/release')
-if not os.path.exists('./target/release/shaders'):
-    os.makedirs('./target/release/shaders')
-if not os.path.exists('./target/release/models'):
-    os.makedirs('./target/release/models')
-if not os.path.exists('./target/release/resource'):
-    os.makedirs('./target/release/resource')
-if not os.path.exists('./target/release/textures'):
-    os.makedirs('./target/release/textures')
-
-if plt == 'Darwin':
-    if not os.path.exists('./target/x86_64-apple-darwin/release'):
-        os.makedirs('./target/x86_64-apple-darwin/release')
-    if not os.path.exists('./target/x86_64-apple-darwin/release/shaders'):
-        os.makedirs('./target/x86_64-apple-darwin/release/shaders')
-    if not os.path.exists('./target/x86_64-apple-darwin/release/models'):
-        os.makedirs('./target/x86_64-apple-darwin/release/models')
-    if not os.path.exists('./target/x86_64-apple-darwin/release/resource'):
-        os.makedirs('./target/x86_64-apple-darwin/release/resource')
-    if not os.path.exists('./target/x86_64-apple-darwin/release/textures'):
-        os.makedirs('./target/x86_64-apple-darwin/release/textures')
-
-# Copy shaders to debug folder
-for x, y in file_names.items():
-    shutil.copyfile('./shaders/' + y, './target/debug/shaders/' + y)
-shutil.copyfile('./.env', './target/debug/.env')
-shutil.rmtree('./target/debug/models')
-shutil.copytree('./models', './target/debug/models')
-
-# Copy shaders to release folder
-for x, y in file_names.items():
-    shutil.copyfile('./shaders/' + y, './target/release/shaders/' + y)
-shutil.copyfile('./.env', './target/release/.env')
-shutil.rmtree('./target/release/models')
-shutil.copytree('./models', './target/release/models')
-
-# Copy shaders to release folder (x86_64-darwin)
-if plt == 'Darwin':
+
+def output_name(src):
+    """Derive the SPIR-V name the game loads for a GLSL source file."""
+    name = os.path.basename(src)
+    if name in OUTPUT_OVERRIDES:
+        return OUTPUT_OVERRIDES[name]
+    stem, suffix = os.path.splitext(name)
+    return '{}_{}.spv'.format(stem, suffix.lstrip('.'))
+
+
+def default_output(src):
+    """glslangValidator's default output name for src: <stage>.spv."""
+    return os.path.splitext(src)[1].lstrip('.') + '.spv'
+
+
+def source_state(src):
+    return [os.stat(src).st_mtime, include_mtimes(src), opt_flag]
+
+
+def needs_rebuild(state, dst, cache):
+    try:
+        dst_mtime = os.stat(dst).st_mtime
+    except FileNotFoundError:
+        return True
+    if max([state[0]] + list(state[1].values())) > dst_mtime:
+        return True
+    return cache.get(dst) != state
+
+
+def spv_path(output):
+    """Final location of a compiled SPIR-V file, under the primary target."""
+    return primary + '/shaders/' + output
+
+
+def run_compiles():
+    """Recompile every stale shader. Touches nothing outside ./shaders, so it
+    can safely overlap the asset syncs."""
+    cache = {}
+    if os.path.exists(SHADER_CACHE):
+        with open(SHADER_CACHE) as f:
+            cache = json.load(f)
+    # Capture each source's state now, before any compiling: a source edited
+    # mid-build must still look stale to the next run.
+    stale = []
     for x, y in file_names.items():
-        shutil.copyfile('./shaders/' + y, './target/x86_64-apple-darwin/release/shaders/' + y)
-        shutil.copyfile('./.env', './target/x86_64-apple-darwin/release/.env')
-        shutil.rmtree('./target/x86_64-apple-darwin/release/models')
-        shutil.copytree('./models', './target/x86_64-apple-darwin/release/models')
-
-# Copy resource to debug and release folder
-shutil.rmtree('./target/debug/resource')
-shutil.copytree('./resource', './target/debug/resource')
-shutil.rmtree('./target/release/resource')
-shutil.copytree('./resource', './target/release/resource')
-if plt == 'Darwin':
-    shutil.rmtree('./target/x86_64-apple-darwin/release/resource')
-    shutil.copytree('./resource', './target/x86_64-apple-darwin/release/resource')
-
-shutil.rmtree('./target/debug/textures')
-shutil.copytree('./textures', './target/debug/textures')
-shutil.rmtree('./target/release/textures')
-shutil.copytree('./textures', './target/release/textures')
-if plt == 'Darwin':
-    shutil.rmtree('./target/x86_64-apple-darwin/release/textures')
-    shutil.copytree('./textures', './target/x86_64-apple-darwin/release/textures')
+        state = source_state('shaders/' + x)
+        if needs_rebuild(state, spv_path(y), cache):
+            stale.append((x, y, state))
+    # Let glslang search shaders/include for shared headers. The batched
+    # command runs with cwd=shaders, the others from the repo root.
+    has_includes = os.path.isdir(INCLUDE_DIR)
+    # The in-process path has no includer wired into its CompileOptions, so
+    # once shared headers exist the compiles must go through glslang, which
+    # gets the include dir on its command line.
+    if shaderc is not None and not has_includes:
+        # libshaderc is thread-safe, so fan the stale shaders out over a pool;
+        # each compile stays in-process instead of paying an exec per shader.
+        compiler = shaderc.Compiler()
+        options = shaderc.CompileOptions()
+        options.set_optimization_level(
+            shaderc.OptimizationLevel.Size if profile == 'release'
+            else shaderc.OptimizationLevel.Zero)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(
+                lambda entry: compile_in_process(
+                    compiler, options,
+                    'shaders/' + entry[0], spv_path(entry[1])),
+                stale))
+    else:
+        # Shaders whose output keeps glslang's default name (<stage>.spv) can
+        # all be handed to a single glslangValidator process, amortizing its
+        # startup cost. Only one shader per stage may do so, or the outputs
+        # would clobber each other.
+        batched = {}
+        renamed = []
+        for x, y, state in stale:
+            if y == default_output(x) and y not in batched:
+                batched[y] = x
+            else:
+                renamed.append((x, y))
+        # Launch every stale compile through Popen up front and reap them in
+        # bulk: the child processes run in parallel on their own, with no
+        # shell and no worker threads in between. Each command is tracked with
+        # the outputs it writes so a failed compile can't leave a stale
+        # SPIR-V behind for the mtime checks to mistake for a fresh one.
+        # The batched command has to run inside ./shaders so the default
+        # output names land somewhere known; the outputs move to the primary
+        # target right after. Everything else writes its SPIR-V straight to
+        # its final location via -o.
+        commands = []
+        if batched:
+            include_args = ['-Iinclude'] if has_includes else []
+            commands.append((['glslangValidator', '-V', opt_flag,
+                              *include_args, *batched.values()],
+                             'shaders', ['shaders/' + y for y in batched]))
+        include_args = ['-I' + INCLUDE_DIR] if has_includes else []
+        commands += [(['glslangValidator', '-V', opt_flag, *include_args,
+                       'shaders/' + x, '-o', spv_path(y)], None,
+                      [spv_path(y)])
+                     for x, y in renamed]
+        # glslangValidator prints its error diagnostics on stdout, so fold
+        # both streams together and surface them on failure.
+        procs = [(subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT), outputs)
+                 for cmd, cwd, outputs in commands]
+        failed = 0
+        for proc, outputs in procs:
+            stdout, _ = proc.communicate()
+            if proc.returncode != 0:
+                sys.stderr.write(stdout.decode(errors='replace'))
+                for output in outputs:
+                    if os.path.exists(output):
+                        os.remove(output)
+                failed = failed or proc.returncode
+        if failed:
+            sys.exit(failed)
+        for y in batched:
+            os.replace('shaders/' + y, spv_path(y))
+    for x, y, state in stale:
+        cache[spv_path(y)] = state
+    with open(SHADER_CACHE, 'w') as f:
+        json.dump(cache, f)
+
+
+plt = platform.system()
+# BUILD_PROFILE=release optimizes the SPIR-V for size (-Os): smaller files to
+# read at startup and less work for the driver's pipeline compiler. The
+# default keeps -Od so debug iteration pays no optimizer cost. The flag is
+# part of the shader cache state, so switching profiles recompiles.
+profile = os.environ.get('BUILD_PROFILE', 'debug')
+opt_flag = '-Os' if profile == 'release' else '-Od'
+
+# Discover shaders instead of hard-coding them, so adding a file to
+# ./shaders is all it takes. Darwin prefers an override source from
+# shaders/macos when one exists.
+file_names = {}
+for shader in sorted(Path('shaders').iterdir()):
+    if shader.suffix not in {'.vert', '.frag', '.comp'}:
+        continue
+    src = shader.name
+    if plt == 'Darwin' and (shader.parent / 'macos' / shader.name).exists():
+        src = 'macos/' + shader.name
+    file_names[src] = output_name(shader.name)
+
+targets = [t for t, enabled in [
+    ('./target/debug', True),
+    ('./target/release', True),
+    ('./target/x86_64-apple-darwin/release', plt == 'Darwin'),
+] if enabled]
+# Compiled SPIR-V is written straight into the first target; the other
+# targets hardlink it from there.
+primary = targets[0]
+
+# Short-circuit the entire script when no input changed since the last
+# successful run and every output is still in place.
+start_snapshot = input_snapshot()
+if os.path.exists(BUILD_CACHE):
+    with open(BUILD_CACHE) as f:
+        if json.load(f) == start_snapshot and outputs_present():
+            sys.exit(0)
+
+# Any failure below must also invalidate the whole-build cache, or the next
+# run could short-circuit on top of a half-updated target folder.
+build_cache_path = os.path.abspath(BUILD_CACHE)
+try:
+    # Create the target folders in case they don't exist; one snapshot per
+    # root replaces a stat per subdirectory.
+    for t in targets:
+        existing = snapshot(t)
+        for sub in ['shaders', 'models', 'resource', 'textures']:
+            if sub not in existing:
+                os.makedirs(t + '/' + sub, exist_ok=True)
+
+    # Shader compilation and the asset-tree syncs read and write disjoint
+    # paths, so overlap the CPU-bound compiles with the I/O-bound copies. Only
+    # the SPIR-V fanout has to wait for the compiles; the asset syncs don't.
+    with ThreadPoolExecutor() as executor:
+        shader_future = executor.submit(run_compiles)
+        asset_futures = [executor.submit(sync_tree, './' + tree, t + '/' + tree)
+                         for tree in ['models', 'resource', 'textures']
+                         for t in targets]
+        shader_future.result()
+
+        # The primary target already holds the freshly compiled SPIR-V;
+        # materialize the remaining targets as hardlinks of it. Recompiles
+        # truncate the primary file in place, so links that already share
+        # its inode stay current for free.
+        for y in file_names.values():
+            src = spv_path(y)
+            for t in targets[1:]:
+                dst = t + '/shaders/' + y
+                if not (os.path.exists(dst) and os.path.samefile(src, dst)):
+                    link_or_copy(src, dst)
+        fanout('./.env', [t + '/.env' for t in targets])
+
+        for future in asset_futures:
+            future.result()
+
+    # Record the snapshot taken at startup, and only after everything above
+    # succeeded: a failed run can never satisfy the short-circuit check, and
+    # an input edited while the build ran still looks changed to the next run.
+    with open(BUILD_CACHE, 'w') as f:
+        json.dump(start_snapshot, f)
+except BaseException:
+    if os.path.exists(build_cache_path):
+        os.remove(build_cache_path)
+    raise